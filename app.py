@@ -1,130 +1,123 @@
 import streamlit as st
 import pandas as pd
-import math
-import os
-from datetime import datetime
-from dataclasses import dataclass
+import numpy as np
+import pyarrow as pa
+import altair as alt
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Dict
 
-# ==========================================
-# 核心底层：量化风控引擎 (Binance 标准)
-# ==========================================
-@dataclass
-class TradeResult:
-    symbol: str
-    direction: str
-    position_size: float   # 持仓币数
-    leverage: int          # 建议杠杆倍数
-    usdt_cost: float       # 投入的USDT本金 (Initial Margin)
-    expected_profit: float # 扣除手续费后的净止盈金额
-    rr_ratio: float        # 真实盈亏比
-    gross_loss: float      # 包含手续费的极限亏损预估
-
-class RiskEngine:
-    def __init__(self, taker_fee: float = 0.0005, mmr: float = 0.004, max_leverage: int = 200):
-        """
-        :param taker_fee: 吃单手续费率 (双边收取)
-        :param mmr: 维持保证金率 (控制爆仓线)
-        :param max_leverage: 平台最高杠杆限制
-        """
-        self.taker_fee = taker_fee
-        self.mmr = mmr
-        self.max_leverage = max_leverage
-
-    def calculate(self, risk_amount: float, entry: float, sl: float, tp: float, symbol: str) -> Union[TradeResult, Dict[str, str]]:
-        # 1. 基础异常拦截
-        if any(v <= 0 for v in [risk_amount, entry, sl, tp]):
-            return {"error": "金额与价格必须大于 0"}
-        if entry == sl:
-            return {"error": "开仓价不可等于止损价"}
-            
-        # 2. 标的与方向判定
-        symbol_fmt = symbol.strip().upper()
-        if not symbol_fmt.endswith("USDT"):
-            symbol_fmt += "USDT"
-            
-        is_long = tp > entry
-        direction = "做多 (Long)" if is_long else "做空 (Short)"
-        
-        # 3. 逻辑冲突拦截
-        if is_long and sl >= entry: return {"error": "多单止损价必须低于开仓价"}
-        if not is_long and sl <= entry: return {"error": "空单止损价必须高于开仓价"}
-        if is_long and tp <= entry: return {"error": "多单止盈价必须高于开仓价"}
-        if not is_long and tp >= entry: return {"error": "空单止盈价必须低于开仓价"}
-
-        try:
-            # 4. 真实仓位计算 (Position Size)
-            # 亏损 = 价格差损耗 + 开仓手续费 + 平仓手续费
-            price_diff = abs(entry - sl)
-            fee_cost_per_coin = self.taker_fee * (entry + sl)
-            position_size = risk_amount / (price_diff + fee_cost_per_coin)
-            
-            # 5. 动态安全杠杆推导 (Leverage)
-            # 初始保证金率必须大于：止损跌幅比例 + 维持保证金率 + 手续费率
-            sl_distance_pct = price_diff / entry
-            safe_margin_rate = sl_distance_pct + self.mmr + (2 * self.taker_fee)
-            raw_leverage = 1 / safe_margin_rate
-            
-            # 截断处理：1x 至 200x
-            final_leverage = max(1, min(self.max_leverage, math.floor(raw_leverage)))
-            
-            # 6. USDT 成本计算 (USDT Cost)
-            notional_value = position_size * entry
-            usdt_cost = notional_value / final_leverage
-            
-            # 7. 止盈利润预估 (扣除开平手续费)
-            tp_diff = abs(tp - entry)
-            gross_profit = position_size * tp_diff
-            tp_fee_cost = self.taker_fee * (entry + tp) * position_size
-            net_profit = gross_profit - tp_fee_cost
-            
-            rr_ratio = net_profit / risk_amount
-            
-            return TradeResult(
-                symbol=symbol_fmt,
-                direction=direction,
-                position_size=position_size,
-                leverage=final_leverage,
-                usdt_cost=usdt_cost,
-                expected_profit=net_profit,
-                rr_ratio=rr_ratio,
-                gross_loss=risk_amount
-            )
-        except Exception as e:
-            return {"error": f"系统计算异常: {str(e)}"}
+from risk_core import (RiskEngine, TradeResult, LOG_COLUMNS, LOG_SCHEMA, read_logs, append_logs,
+                       register_pending_logs, take_pending_logs, restore_pending_logs)
 
 # ==========================================
-# 本地日志持久化模块 (替代 GSheets 避免崩溃)
+# 日志缓存层 (读缓存 + 写入后失效)
 # ==========================================
-LOG_FILE = "trade_logs.csv"
+LOG_FLUSH_SIZE = 5  # 待写入条数达到该值时自动批量落盘
+HISTORY_ROWS = 10   # 复盘面板展示的最近记录条数
 
+@st.cache_data(ttl=60, show_spinner=False)
 def load_logs() -> pd.DataFrame:
-    if os.path.exists(LOG_FILE):
-        return pd.read_csv(LOG_FILE)
-    return pd.DataFrame()
-
-def save_log(data: dict):
-    df = pd.DataFrame([data])
-    if not os.path.exists(LOG_FILE):
-        df.to_csv(LOG_FILE, index=False)
-    else:
-        df.to_csv(LOG_FILE, mode='a', header=False, index=False)
+    return read_logs()
+
+def save_logs(rows: list, pending: list):
+    try:
+        append_logs(rows)
+    except Exception:
+        # 在写入线程内直接退回所属会话的队列：不依赖该会话之后还有 rerun
+        restore_pending_logs(pending, rows)
+        raise
+    load_logs.clear()  # 写入后失效读缓存，下次渲染读取最新日志
 
 # ==========================================
 # 前端 UI 与 交互主逻辑
 # ==========================================
+@st.cache_resource
+def get_engine() -> RiskEngine:
+    # 引擎为无状态单例，跨 rerun 与会话复用，避免每次交互重复构造
+    return RiskEngine()
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def compute_trade(risk_amount: float, entry: float, sl: float, tp: float, symbol: str) -> Union[TradeResult, Dict[str, str]]:
+    # 纯函数按输入记忆化：相同参数重复推导直接命中缓存；条目数设上限，避免长期运行时缓存无界增长
+    return get_engine().calculate(risk_amount, entry, sl, tp, symbol)
+
+@st.cache_resource
+def get_log_writer() -> ThreadPoolExecutor:
+    # 单线程写入器：落盘移出脚本线程，同时保证多会话对同一文件串行追加
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-writer")
+
+def flush_pending_logs():
+    # 提交后台写入后立即返回，当前 rerun 不等待磁盘 I/O；队列清空后随即注销登记
+    pending = st.session_state.pending_logs
+    if pending:
+        rows = take_pending_logs(pending)
+        future = get_log_writer().submit(save_logs, rows, pending)
+        st.session_state.inflight_logs.append((future, rows))
+
+def reap_inflight_logs() -> list:
+    # 回收已完成的后台写入：成功批次直接并入会话内历史 (无需回读文件)，失败批次已由写入线程退回待写入队列，返回仍在写入中的记录
+    writing = []
+    for future, rows in st.session_state.inflight_logs:
+        if not future.done():
+            writing.append((future, rows))
+        elif future.exception() is not None:
+            st.error(f"❌ 日志写入失败，已退回待写入队列：{future.exception()}")
+        else:
+            st.session_state.history_tail.extend(rows)
+            st.session_state.history_view = None
+    st.session_state.inflight_logs = writing
+    return [row for _, rows in writing for row in rows]
+
+def render_rr_heatmap(risk_amount: float, entry: float, sl: float, tp: float, density: int):
+    # 以当前止损 / 止盈距离为基准，在 0.25x ~ 2x 范围内扫描 density × density 网格
+    is_long = tp > entry
+    sign = 1 if is_long else -1
+    sl_dist, tp_dist = abs(entry - sl), abs(tp - entry)
+    # 朝下方向 (多单止损 / 空单止盈) 的距离上限不得触及 0 价
+    sl_hi = min(2 * sl_dist, 0.95 * entry) if is_long else 2 * sl_dist
+    tp_hi = 2 * tp_dist if is_long else min(2 * tp_dist, 0.95 * entry)
+    stops = entry - sign * np.linspace(0.25 * sl_dist, sl_hi, density)
+    tps = entry + sign * np.linspace(0.25 * tp_dist, tp_hi, density)
+
+    leverage, rr_ratio = get_engine().calculate_grid(risk_amount, entry, stops, tps)
+    grid_df = pd.DataFrame({
+        '止损价': np.repeat(stops, density),
+        '止盈价': np.tile(tps, density),
+        '杠杆': leverage.ravel(),
+        '盈亏比': rr_ratio.ravel(),
+    })
+    chart = alt.Chart(grid_df).mark_rect().encode(
+        x=alt.X('止盈价:O', axis=alt.Axis(format='.6~g', labelOverlap=True)),
+        y=alt.Y('止损价:O', axis=alt.Axis(format='.6~g', labelOverlap=True)),
+        color=alt.Color('盈亏比:Q', scale=alt.Scale(scheme='redyellowgreen')),
+        tooltip=[alt.Tooltip('止损价:Q', format='.6~g'), alt.Tooltip('止盈价:Q', format='.6~g'),
+                 alt.Tooltip('杠杆:Q'), alt.Tooltip('盈亏比:Q', format='.2f')],
+    )
+    st.altair_chart(chart, use_container_width=True)
+
 def main():
     st.set_page_config(page_title="量化风控引擎", page_icon="📈", layout="wide")
     st.title("🛡️ 交易杠杆与风控推导系统 (实盘标准版)")
     st.markdown("基于 **绝对亏损金额** 全自动反推安全杠杆与投入本金。已内置币安维持保证金与双边手续费损耗模型。")
 
-    engine = RiskEngine()
+    if "pending_logs" not in st.session_state:
+        # 历史只在会话首次渲染时读取一次，之后由本会话的写入增量维护
+        # 定长环形缓冲：只保留展示所需的最近记录，追加为 O(1)，与日志总量无关
+        history_tail = deque(load_logs().tail(HISTORY_ROWS).to_dict('records'), maxlen=HISTORY_ROWS)
+        # 读取成功后才写入会话状态，守卫键 pending_logs 最后设置：首次读取异常时下次 rerun 会完整重试初始化
+        st.session_state.inflight_logs = []
+        st.session_state.history_tail = history_tail
+        st.session_state.history_view = None
+        st.session_state.pending_logs = []
 
     col1, col2 = st.columns([1, 1.5])
 
     with col1:
         st.subheader("1. 交易参数设置")
-        with st.container(border=True):
+        # 表单内的输入变更不触发 rerun，提交时一次性批量生效
+        with st.form("calc"):
             raw_symbol = st.text_input("交易币种 (自动追加 USDT)", value="BTC").strip()
             risk_amount = st.number_input("固定止损金额 (Risk USDT)", min_value=1.0, value=50.0, step=10.0)
             
@@ -132,14 +125,24 @@ def main():
             entry_price = st.number_input("开仓价格 (Entry)", min_value=0.00001, value=60000.0, format="%.5f")
             stop_loss = st.number_input("止损价格 (Stop Loss)", min_value=0.00001, value=59500.0, format="%.5f")
             take_profit = st.number_input("止盈价格 (Take Profit)", min_value=0.00001, value=62000.0, format="%.5f")
+            # 热力图按需生成：未勾选时提交不计算网格、不构建图表
+            show_heatmap = st.toggle("生成 R:R 热力图", value=False)
+            grid_density = st.slider("R:R 热力图网格密度", min_value=10, max_value=60, value=30, step=5)
             
-            calculate_btn = st.button("⚡ 执行风控推导", type="primary", use_container_width=True)
+            calculate_btn = st.form_submit_button("⚡ 执行风控推导", type="primary", use_container_width=True)
 
     with col2:
         st.subheader("2. 智能风控执行面板")
         
         if calculate_btn:
-            result = engine.calculate(risk_amount, entry_price, stop_loss, take_profit, raw_symbol)
+            # 一级缓存：输入签名与上次一致时直接复用会话内结果；二级为 compute_trade 的跨会话缓存
+            input_sig = (risk_amount, entry_price, stop_loss, take_profit, raw_symbol)
+            if st.session_state.get("input_sig") == input_sig:
+                result = st.session_state.last_result
+            else:
+                result = compute_trade(*input_sig)
+                st.session_state.input_sig = input_sig
+                st.session_state.last_result = result
             
             if isinstance(result, dict) and "error" in result:
                 st.error(f"❌ 逻辑错误：{result['error']}")
@@ -159,7 +162,7 @@ def main():
                 
                 # 记录日志
                 log_data = {
-                    '时间': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    '时间': time.strftime("%Y-%m-%d %H:%M:%S"),
                     '标的': result.symbol,
                     '方向': result.direction,
                     '杠杆': f"{result.leverage}x",
@@ -168,14 +171,36 @@ def main():
                     '止损价': stop_loss,
                     '净利润': round(result.expected_profit, 2)
                 }
-                save_log(log_data)
-                st.info("📝 交易策略已通过底层校验，并写入本地日志 `trade_logs.csv`。")
+                st.session_state.pending_logs.append(log_data)
+                register_pending_logs(st.session_state.pending_logs)
+                if len(st.session_state.pending_logs) >= LOG_FLUSH_SIZE:
+                    flush_pending_logs()
+                    st.info("📝 交易策略已通过底层校验，已提交批量写入本地日志 `trade_logs.csv`。")
+                else:
+                    st.info(f"📝 交易策略已通过底层校验，已加入待写入队列 ({len(st.session_state.pending_logs)}/{LOG_FLUSH_SIZE})。")
+
+                if show_heatmap:
+                    with st.expander("🔥 止损 / 止盈 网格扫描 (R:R 热力图)", expanded=True):
+                        render_rr_heatmap(risk_amount, entry_price, stop_loss, take_profit, grid_density)
 
     st.divider()
     st.subheader("📊 历史策略复盘")
-    logs_df = load_logs()
-    if not logs_df.empty:
-        st.dataframe(logs_df.tail(10).iloc[::-1], use_container_width=True) # 倒序显示最新
+    writing_logs = reap_inflight_logs()
+    pending_count = len(st.session_state.pending_logs)
+    if pending_count:
+        st.button(f"💾 立即写入日志 ({pending_count} 条待写入)", on_click=flush_pending_logs)
+    # 倒序视图按 (写入中, 待写入) 条数缓存，队列不变时直接复用，不再每次 rerun 复制反转
+    view_key = (len(writing_logs), len(st.session_state.pending_logs))
+    if st.session_state.history_view is None or st.session_state.history_view_key != view_key:
+        # 已落盘记录与待写入队列统一按 dict 列表累积，只在此处物化一次 DataFrame
+        records = [*st.session_state.history_tail, *writing_logs, *st.session_state.pending_logs]
+        recent = records[-HISTORY_ROWS:][::-1]  # 倒序显示最新
+        # 直接缓存 Arrow 表，渲染时跳过 pandas -> Arrow 的重复转换
+        recent_df = pd.DataFrame(recent, columns=LOG_COLUMNS).astype(LOG_SCHEMA)
+        st.session_state.history_view = pa.Table.from_pandas(recent_df, preserve_index=False)
+        st.session_state.history_view_key = view_key
+    if st.session_state.history_view.num_rows:
+        st.dataframe(st.session_state.history_view, use_container_width=True)
     else:
         st.write("暂无历史交易数据。")
 
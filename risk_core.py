@@ -0,0 +1,256 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
+import csv
+import time
+import atexit
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Union, Dict, Tuple, Optional
+
+try:
+    from numba import njit
+except ImportError:  # 未安装 numba 时退化为纯 Python 执行，计算结果一致
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# ==========================================
+# 核心底层：量化风控引擎 (Binance 标准)
+# ==========================================
+@dataclass(slots=True)
+class TradeResult:
+    symbol: str
+    direction: str
+    position_size: float   # 持仓币数
+    leverage: int          # 建议杠杆倍数
+    usdt_cost: float       # 投入的USDT本金 (Initial Margin)
+    expected_profit: float # 扣除手续费后的净止盈金额
+    rr_ratio: float        # 真实盈亏比
+    gross_loss: float      # 包含手续费的极限亏损预估
+
+# 显式签名使 numba 在模块导入时即完成编译 (并落盘缓存)，首次点击推导不再承担 JIT 延迟
+@njit('Tuple((f8, i8, f8, f8, f8))(f8, f8, f8, f8, f8, f8, i8)', cache=True)
+def _risk_core(risk_amount, entry, sl, tp, taker_fee, mmr, max_leverage):
+    # 纯标量数值核心：校验与结果封装留在 Python 层，此处可被 numba 编译为原生代码
+    # 4. 真实仓位计算 (Position Size)
+    # 亏损 = 价格差损耗 + 开仓手续费 + 平仓手续费
+    price_diff = abs(entry - sl)
+    fee_cost_per_coin = taker_fee * (entry + sl)
+    position_size = risk_amount / (price_diff + fee_cost_per_coin)
+    
+    # 5. 动态安全杠杆推导 (Leverage)
+    # 初始保证金率必须大于：止损跌幅比例 + 维持保证金率 + 手续费率
+    sl_distance_pct = price_diff / entry
+    # 保持原始加法顺序 (止损比例 + 维持保证金率) + 双边手续费率：浮点加法不满足结合律，
+    # 预先合并后两项会使整数止损比例处的杠杆向上翻转一档
+    safe_margin_rate = sl_distance_pct + mmr + (2 * taker_fee)
+    raw_leverage = 1 / safe_margin_rate
+    
+    # 截断处理：1x 至 200x (raw_leverage 恒为正，int 截断即向下取整)
+    final_leverage = max(1, min(max_leverage, int(raw_leverage)))
+    
+    # 6. USDT 成本计算 (USDT Cost)
+    notional_value = position_size * entry
+    usdt_cost = notional_value / final_leverage
+    
+    # 7. 止盈利润预估 (扣除开平手续费)
+    tp_diff = abs(tp - entry)
+    gross_profit = position_size * tp_diff
+    tp_fee_cost = taker_fee * (entry + tp) * position_size
+    net_profit = gross_profit - tp_fee_cost
+    
+    rr_ratio = net_profit / risk_amount
+    return position_size, final_leverage, usdt_cost, net_profit, rr_ratio
+
+# 同样显式签名在导入时编译，首次渲染热力图时脚本线程不再等待 JIT
+@njit('Tuple((i8[:, :], f8[:, :]))(f8, f8, f8[::1], f8[::1], f8, f8, i8)', cache=True)
+def _risk_grid(risk_amount, entry, stops, tps, taker_fee, mmr, max_leverage):
+    # 止损 × 止盈 网格批量推导：整个双层循环在原生代码中执行，逐点复用标量核心
+    leverage = np.empty((stops.size, tps.size), dtype=np.int64)
+    rr_ratio = np.empty((stops.size, tps.size))
+    for i in range(stops.size):
+        for j in range(tps.size):
+            _, lev, _, _, rr = _risk_core(risk_amount, entry, stops[i], tps[j], taker_fee, mmr, max_leverage)
+            leverage[i, j] = lev
+            rr_ratio[i, j] = rr
+    return leverage, rr_ratio
+
+def _validate_direction(entry: float, sl: float, tp: float) -> Tuple[bool, Optional[str]]:
+    # 以方向符号统一多空校验：合法输入只需两次比较，具体错误文案仅在失败路径上生成
+    is_long = tp > entry
+    sign = 1 if is_long else -1
+    if (entry - sl) * sign > 0 and (tp - entry) * sign > 0:
+        return is_long, None
+    if (entry - sl) * sign <= 0:
+        return is_long, "多单止损价必须低于开仓价" if is_long else "空单止损价必须高于开仓价"
+    return is_long, "多单止盈价必须高于开仓价" if is_long else "空单止盈价必须低于开仓价"
+
+class RiskEngine:
+    __slots__ = ('taker_fee', 'mmr', 'max_leverage')
+
+    def __init__(self, taker_fee: float = 0.0005, mmr: float = 0.004, max_leverage: int = 200):
+        """
+        :param taker_fee: 吃单手续费率 (双边收取)
+        :param mmr: 维持保证金率 (控制爆仓线)
+        :param max_leverage: 平台最高杠杆限制
+        """
+        self.taker_fee = taker_fee
+        self.mmr = mmr
+        self.max_leverage = max_leverage
+
+    def calculate(self, risk_amount: float, entry: float, sl: float, tp: float, symbol: str) -> Union[TradeResult, Dict[str, str]]:
+        # 1. 基础异常拦截
+        if any(v <= 0 for v in [risk_amount, entry, sl, tp]):
+            return {"error": "金额与价格必须大于 0"}
+        if entry == sl:
+            return {"error": "开仓价不可等于止损价"}
+            
+        # 2. 标的格式化
+        symbol_fmt = symbol.strip().upper()
+        if not symbol_fmt.endswith("USDT"):
+            symbol_fmt += "USDT"
+            
+        # 3. 方向判定与逻辑冲突拦截
+        is_long, error = _validate_direction(entry, sl, tp)
+        if error:
+            return {"error": error}
+        direction = "做多 (Long)" if is_long else "做空 (Short)"
+
+        try:
+            position_size, final_leverage, usdt_cost, net_profit, rr_ratio = _risk_core(
+                risk_amount, entry, sl, tp, self.taker_fee, self.mmr, self.max_leverage
+            )
+            
+            return TradeResult(
+                symbol=symbol_fmt,
+                direction=direction,
+                position_size=position_size,
+                leverage=final_leverage,
+                usdt_cost=usdt_cost,
+                expected_profit=net_profit,
+                rr_ratio=rr_ratio,
+                gross_loss=risk_amount
+            )
+        except Exception as e:
+            return {"error": f"系统计算异常: {str(e)}"}
+
+    def calculate_grid(self, risk_amount: float, entry: float, stops: np.ndarray, tps: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量推导止损价 × 止盈价网格，返回 (杠杆矩阵, 盈亏比矩阵)，形状均为 (len(stops), len(tps))
+        调用方需保证网格内所有价格均为正且与开仓价方向一致 (与 calculate 的校验规则相同)
+        """
+        return _risk_grid(
+            float(risk_amount), float(entry),
+            np.ascontiguousarray(stops, dtype=np.float64), np.ascontiguousarray(tps, dtype=np.float64),
+            self.taker_fee, self.mmr, self.max_leverage
+        )
+
+# ==========================================
+# 本地日志持久化模块 (替代 GSheets 避免崩溃)
+# ==========================================
+LOG_FILE = "trade_logs.csv"
+LOG_CACHE_FILE = "trade_logs.parquet"  # 读取用列式镜像，CSV 仍是唯一的追加写入源
+LOG_CACHE_SIZE_KEY = b'csv_size'       # 镜像 schema 元数据中记录生成时 CSV 字节数的键
+LOG_COLUMNS = ('时间', '标的', '方向', '杠杆', '投入USDT', '开仓价', '止损价', '净利润')
+# 固定列类型：读取与物化时直接套用，跳过 pandas 的逐列类型推断
+LOG_SCHEMA = {'时间': 'string', '标的': 'string', '方向': 'string', '杠杆': 'string',
+              '投入USDT': 'float64', '开仓价': 'float64', '止损价': 'float64', '净利润': 'float64'}
+# 数值列按界面精度预先格式化为定长文本 (金额 2 位、价格 5 位)，避免 repr 输出科学计数法
+LOG_FORMATS = {'投入USDT': '{:.2f}', '开仓价': '{:.5f}', '止损价': '{:.5f}', '净利润': '{:.2f}'}
+LOG_WRITE_RETRIES = 4  # 文件被占用 (如 Excel 打开) 时的重试次数，指数退避 0.5s/1s/2s/4s
+
+def format_log_row(data: dict) -> list:
+    return [LOG_FORMATS[col].format(data[col]) if col in LOG_FORMATS else data[col] for col in LOG_COLUMNS]
+
+def read_logs() -> pd.DataFrame:
+    if not os.path.exists(LOG_FILE):
+        return pd.DataFrame()
+    # 镜像新鲜度以 CSV 的 (mtime, size) 判定：mtime 被对齐到镜像文件本身，size 写入镜像的 schema 元数据。
+    # 单比 mtime 在粗粒度时间戳的文件系统上会漏掉同一时间片内的追加；stat 在读 CSV 之前取，宁可多重建一次也不误用旧镜像
+    csv_stat = os.stat(LOG_FILE)
+    csv_key = (csv_stat.st_mtime_ns, csv_stat.st_size)
+    try:
+        with pq.ParquetFile(LOG_CACHE_FILE) as cache:
+            cache_size = int((cache.schema_arrow.metadata or {}).get(LOG_CACHE_SIZE_KEY, -1))
+            if (os.stat(LOG_CACHE_FILE).st_mtime_ns, cache_size) == csv_key:
+                return cache.read().to_pandas()
+    except (OSError, pa.ArrowException, ValueError):
+        pass  # 镜像缺失或损坏时直接读 CSV 并重建
+    df = pd.read_csv(LOG_FILE, dtype=LOG_SCHEMA, usecols=lambda col: col in LOG_SCHEMA)
+    # 先写同目录临时文件再原子替换，其他读取方不会读到写了一半的镜像
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(LOG_CACHE_FILE) + '.', suffix='.tmp',
+                                        dir=os.path.dirname(os.path.abspath(LOG_CACHE_FILE)))
+        os.close(fd)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), LOG_CACHE_SIZE_KEY: str(csv_stat.st_size).encode()})
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, LOG_CACHE_FILE)
+        os.utime(LOG_CACHE_FILE, ns=(csv_stat.st_mtime_ns, csv_stat.st_mtime_ns))
+    except (OSError, pa.ArrowException, ValueError):
+        pass  # 镜像仅用于加速，生成失败时退回直接读 CSV
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return df
+
+def append_logs(rows: list):
+    # 仅追加新行：不回读历史、不构造 DataFrame，一批记录只打开一次文件
+    if not rows:
+        return
+    for attempt in range(LOG_WRITE_RETRIES + 1):
+        try:
+            _write_rows(rows)
+            return
+        except PermissionError:
+            # 文件锁属于暂时性失败，退避后重试；其余 I/O 异常直接上抛由调用方保留数据
+            if attempt == LOG_WRITE_RETRIES:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+def _write_rows(rows: list):
+    # 64KB 缓冲使整批记录在关闭时一次落盘；utf-8-sig 在追加模式下仅于空文件开头写入 BOM，
+    # 便于 Excel 正确识别中文表头
+    with open(LOG_FILE, 'a', newline='', encoding='utf-8-sig', buffering=1 << 16) as f:
+        writer = csv.writer(f)
+        # 追加模式打开后位置即文件末尾：位置为 0 说明是新文件 (或被清空)，无需额外 stat
+        if f.tell() == 0:
+            writer.writerow(LOG_COLUMNS)
+        writer.writerows(map(format_log_row, rows))
+
+# ==========================================
+# 进程级待写入登记 (退出时补写未落盘记录)
+# ==========================================
+# 按对象 id 登记持有未落盘记录的会话队列，队列清空即注销，登记表不随会话累积增长。
+# 模块在每个进程只导入一次，登记表与退出钩子因此全局唯一，不受 Streamlit 清空缓存影响
+_pending_registry: Dict[int, list] = {}
+_pending_lock = threading.Lock()  # 脚本线程取出队列与写入线程退回失败批次互斥
+
+def register_pending_logs(pending: list):
+    # 队列新增记录后调用，确保非空队列处于登记状态
+    _pending_registry[id(pending)] = pending
+
+def take_pending_logs(pending: list) -> list:
+    # 取出并清空队列，同时注销登记；返回取出的记录
+    with _pending_lock:
+        rows = pending.copy()
+        pending.clear()
+        _pending_registry.pop(id(pending), None)
+    return rows
+
+def restore_pending_logs(pending: list, rows: list):
+    # 写入失败的批次退回队列头部并重新登记：由写入线程直接调用，会话已关闭时记录仍会在退出时补写
+    with _pending_lock:
+        pending[:0] = rows
+        _pending_registry[id(pending)] = pending
+
+@atexit.register
+def _flush_registered_logs():
+    # 后台写入线程在 atexit 钩子之前已被 concurrent.futures 收尾 (失败批次已退回登记)，此处直接同步追加
+    append_logs([row for pending in list(_pending_registry.values()) for row in pending])
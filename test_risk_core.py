@@ -0,0 +1,278 @@
+import math
+import os
+import random
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+import risk_core
+from risk_core import (RiskEngine, TradeResult, LOG_CACHE_FILE, LOG_COLUMNS, LOG_FILE, LOG_SCHEMA, LOG_WRITE_RETRIES,
+                       append_logs, format_log_row, read_logs)
+
+TAKER_FEE, MMR, MAX_LEVERAGE = 0.0005, 0.004, 200
+
+
+def reference_calculate(risk_amount, entry, sl, tp):
+    # 重构前 RiskEngine.calculate 的原始公式 (逐行内联)，作为数值对拍基准
+    price_diff = abs(entry - sl)
+    fee_cost_per_coin = TAKER_FEE * (entry + sl)
+    position_size = risk_amount / (price_diff + fee_cost_per_coin)
+
+    sl_distance_pct = price_diff / entry
+    safe_margin_rate = sl_distance_pct + MMR + (2 * TAKER_FEE)
+    raw_leverage = 1 / safe_margin_rate
+    final_leverage = max(1, min(MAX_LEVERAGE, math.floor(raw_leverage)))
+
+    notional_value = position_size * entry
+    usdt_cost = notional_value / final_leverage
+
+    tp_diff = abs(tp - entry)
+    gross_profit = position_size * tp_diff
+    tp_fee_cost = TAKER_FEE * (entry + tp) * position_size
+    net_profit = gross_profit - tp_fee_cost
+
+    rr_ratio = net_profit / risk_amount
+    return position_size, final_leverage, usdt_cost, net_profit, rr_ratio
+
+
+def assert_matches_reference(result, risk_amount, entry, sl, tp):
+    assert isinstance(result, TradeResult)
+    position_size, leverage, usdt_cost, net_profit, rr_ratio = reference_calculate(risk_amount, entry, sl, tp)
+    assert result.leverage == leverage
+    assert result.position_size == pytest.approx(position_size, rel=1e-12)
+    assert result.usdt_cost == pytest.approx(usdt_cost, rel=1e-12)
+    assert result.expected_profit == pytest.approx(net_profit, rel=1e-12)
+    assert result.rr_ratio == pytest.approx(rr_ratio, rel=1e-12)
+    assert result.gross_loss == risk_amount
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return RiskEngine(taker_fee=TAKER_FEE, mmr=MMR, max_leverage=MAX_LEVERAGE)
+
+
+@pytest.mark.parametrize("risk_amount, entry, sl, tp, direction", [
+    (50.0, 60000.0, 59500.0, 62000.0, "做多 (Long)"),
+    (50.0, 60000.0, 60500.0, 58000.0, "做空 (Short)"),
+    (10.0, 0.00012, 0.00011, 0.00015, "做多 (Long)"),
+    (10.0, 100.0, 150.0, 20.0, "做空 (Short)"),
+    (10.0, 100.0, 99.99, 101.0, "做多 (Long)"),   # 极窄止损：杠杆被截断至上限
+    (10.0, 100.0, 5.0, 300.0, "做多 (Long)"),     # 极宽止损：杠杆被截断至 1x
+    # 整数止损比例：杠杆取整恰好落在边界附近，对浮点运算顺序敏感
+    (50.0, 60000.0, 59700.0, 61000.0, "做多 (Long)"),   # 0.5%
+    (50.0, 60000.0, 59700.0, 62000.0, "做多 (Long)"),   # 0.5%
+    (50.0, 60000.0, 59400.0, 62000.0, "做多 (Long)"),   # 1%
+    (50.0, 60000.0, 58800.0, 62000.0, "做多 (Long)"),   # 2%
+    (50.0, 60000.0, 57900.0, 62000.0, "做多 (Long)"),   # 3.5%
+    (50.0, 100.0, 96.5, 110.0, "做多 (Long)"),          # 3.5%
+    (50.0, 100.0, 90.0, 110.0, "做多 (Long)"),          # 10%
+    (50.0, 1000.0, 1005.0, 900.0, "做空 (Short)"),      # 0.5%
+    (50.0, 1000.0, 1035.0, 900.0, "做空 (Short)"),      # 3.5%
+    (50.0, 60000.0, 66000.0, 50000.0, "做空 (Short)"),  # 10%
+])
+def test_calculate_matches_original_formulas(engine, risk_amount, entry, sl, tp, direction):
+    result = engine.calculate(risk_amount, entry, sl, tp, " btc ")
+    assert_matches_reference(result, risk_amount, entry, sl, tp)
+    assert result.direction == direction
+    assert result.symbol == "BTCUSDT"
+
+
+def test_symbol_suffix_not_duplicated(engine):
+    assert engine.calculate(50.0, 60000.0, 59500.0, 62000.0, "ethusdt").symbol == "ETHUSDT"
+
+
+@pytest.mark.parametrize("risk_amount, entry, sl, tp, error", [
+    (0.0, 100.0, 90.0, 110.0, "金额与价格必须大于 0"),
+    (10.0, -1.0, 90.0, 110.0, "金额与价格必须大于 0"),
+    (10.0, 100.0, 100.0, 110.0, "开仓价不可等于止损价"),
+    (10.0, 100.0, 101.0, 110.0, "多单止损价必须低于开仓价"),
+    (10.0, 100.0, 99.0, 90.0, "空单止损价必须高于开仓价"),
+    (10.0, 100.0, 110.0, 120.0, "多单止损价必须低于开仓价"),
+    # tp == entry 按空单处理：止损在下方先报止损错误，止损在上方则报止盈错误
+    (10.0, 100.0, 90.0, 100.0, "空单止损价必须高于开仓价"),
+    (10.0, 100.0, 110.0, 100.0, "空单止盈价必须低于开仓价"),
+])
+def test_calculate_errors(engine, risk_amount, entry, sl, tp, error):
+    assert engine.calculate(risk_amount, entry, sl, tp, "BTC") == {"error": error}
+
+
+def test_calculate_random_parity(engine):
+    rng = random.Random(20240601)
+    for _ in range(5000):
+        entry = rng.choice([rng.uniform(1e-5, 1.0), rng.uniform(1.0, 1e5)])
+        offset_sl, offset_tp = rng.uniform(0.001, 0.5), rng.uniform(0.001, 0.5)
+        sign = rng.choice([1, -1])
+        sl, tp = entry * (1 - sign * offset_sl), entry * (1 + sign * offset_tp)
+        risk_amount = rng.uniform(1.0, 500.0)
+        assert_matches_reference(engine.calculate(risk_amount, entry, sl, tp, "BTC"), risk_amount, entry, sl, tp)
+
+
+@pytest.mark.parametrize("entry", [1.0, 100.0, 1000.0, 60000.0, 0.001])
+def test_calculate_round_stop_parity(engine, entry):
+    # 随机采样几乎不会命中 k/1000 这类整数止损比例，单独逐档扫描杠杆取整边界
+    for k in range(1, 1000):
+        for sign in (1, -1):
+            sl, tp = entry * (1 - sign * k / 1000), entry * (1 + sign * 0.05)
+            assert_matches_reference(engine.calculate(50.0, entry, sl, tp, "BTC"), 50.0, entry, sl, tp)
+
+
+def test_calculate_grid_matches_calculate(engine):
+    entry = 60000.0
+    stops = np.linspace(59000.0, 59900.0, 7)
+    tps = np.linspace(60100.0, 63000.0, 5)
+    leverage, rr_ratio = engine.calculate_grid(50.0, entry, stops, tps)
+    assert leverage.shape == rr_ratio.shape == (7, 5)
+    for i, sl in enumerate(stops):
+        for j, tp in enumerate(tps):
+            result = engine.calculate(50.0, entry, sl, tp, "BTC")
+            assert leverage[i, j] == result.leverage
+            assert rr_ratio[i, j] == pytest.approx(result.rr_ratio, rel=1e-12)
+
+
+def make_log_row(entry=60000.0):
+    return {'时间': '2024-01-01 00:00:00', '标的': 'BTCUSDT', '方向': '做多 (Long)', '杠杆': '10x',
+            '投入USDT': 123.45, '开仓价': entry, '止损价': entry * 0.99, '净利润': 67.89}
+
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    # 日志路径为相对路径，切换到临时目录即可隔离读写
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def assert_no_tmp_files(directory):
+    assert not [name for name in os.listdir(directory) if name.endswith('.tmp')]
+
+
+def test_read_logs_missing_file(log_dir):
+    assert read_logs().empty
+    assert not os.path.exists(LOG_CACHE_FILE)
+
+
+def test_read_logs_builds_mirror_then_hits_it(log_dir, monkeypatch):
+    append_logs([make_log_row(), make_log_row(100.0)])
+    first = read_logs()
+    assert len(first) == 2
+    assert first.dtypes.to_dict() == {col: pd.Series(dtype=dtype).dtype for col, dtype in LOG_SCHEMA.items()}
+    assert os.stat(LOG_CACHE_FILE).st_mtime_ns == os.stat(LOG_FILE).st_mtime_ns
+    assert_no_tmp_files(log_dir)
+
+    def fail_read_csv(*args, **kwargs):
+        raise AssertionError("镜像命中时不应解析 CSV")
+    monkeypatch.setattr(risk_core.pd, "read_csv", fail_read_csv)
+    pd.testing.assert_frame_equal(read_logs(), first)
+
+
+def test_read_logs_rebuilds_after_append(log_dir):
+    append_logs([make_log_row()])
+    assert len(read_logs()) == 1
+    append_logs([make_log_row(), make_log_row()])
+    assert len(read_logs()) == 3
+    assert pq.ParquetFile(LOG_CACHE_FILE).metadata.num_rows == 3
+    assert_no_tmp_files(log_dir)
+
+
+def test_read_logs_rebuilds_after_same_mtime_append(log_dir):
+    # 粗粒度时间戳下追加可能不改变 mtime：大小不同也必须判定为过期
+    append_logs([make_log_row()])
+    assert len(read_logs()) == 1
+    csv_mtime = os.stat(LOG_FILE).st_mtime_ns
+    append_logs([make_log_row()])
+    os.utime(LOG_FILE, ns=(csv_mtime, csv_mtime))
+    assert len(read_logs()) == 2
+    assert_no_tmp_files(log_dir)
+
+
+def test_read_logs_falls_back_on_corrupt_mirror(log_dir):
+    append_logs([make_log_row(), make_log_row()])
+    read_logs()
+    csv_mtime = os.stat(LOG_FILE).st_mtime_ns
+    with open(LOG_CACHE_FILE, 'wb') as f:
+        f.write(b'not a parquet file')
+    os.utime(LOG_CACHE_FILE, ns=(csv_mtime, csv_mtime))
+    assert len(read_logs()) == 2
+    assert pq.ParquetFile(LOG_CACHE_FILE).metadata.num_rows == 2  # 损坏的镜像已被重建
+    assert_no_tmp_files(log_dir)
+
+
+BOM = '\ufeff'.encode('utf-8')
+
+
+def read_log_bytes():
+    with open(LOG_FILE, 'rb') as f:
+        return f.read()
+
+
+def test_append_logs_writes_header_and_bom_on_new_file(log_dir):
+    append_logs([make_log_row()])
+    raw = read_log_bytes()
+    assert raw.startswith(BOM + ','.join(LOG_COLUMNS).encode('utf-8') + b'\r\n')
+    assert raw.count(BOM) == 1
+
+
+def test_append_logs_writes_header_on_existing_empty_file(log_dir):
+    open(LOG_FILE, 'w').close()
+    append_logs([make_log_row()])
+    lines = read_log_bytes().splitlines()
+    assert lines[0] == BOM + ','.join(LOG_COLUMNS).encode('utf-8')
+    assert len(lines) == 2
+
+
+def test_append_logs_no_second_header_or_bom(log_dir):
+    append_logs([make_log_row()])
+    append_logs([make_log_row(), make_log_row()])
+    raw = read_log_bytes()
+    assert raw.count(BOM) == 1
+    assert raw.count(','.join(LOG_COLUMNS).encode('utf-8')) == 1
+    assert len(raw.splitlines()) == 4
+    assert len(read_logs()) == 3
+
+
+def test_format_log_row_fixed_precision():
+    row = format_log_row({**make_log_row(), '投入USDT': 0.004, '开仓价': 0.00001, '止损价': 0.0000123456, '净利润': 1e-7})
+    assert row == ['2024-01-01 00:00:00', 'BTCUSDT', '做多 (Long)', '10x', '0.00', '0.00001', '0.00001', '0.00']
+    assert not any('e' in value for value in row[4:])
+
+
+def test_append_logs_retries_then_succeeds(log_dir, monkeypatch):
+    sleeps, calls = [], []
+    write_rows = risk_core._write_rows
+
+    def flaky_write(rows):
+        calls.append(rows)
+        if len(calls) < 3:
+            raise PermissionError("file is locked")
+        write_rows(rows)
+    monkeypatch.setattr(risk_core, "_write_rows", flaky_write)
+    monkeypatch.setattr(risk_core.time, "sleep", sleeps.append)
+    append_logs([make_log_row()])
+    assert sleeps == [0.5, 1.0]
+    assert len(read_logs()) == 1
+
+
+def test_append_logs_reraises_after_retries(log_dir, monkeypatch):
+    sleeps = []
+
+    def locked_write(rows):
+        raise PermissionError("file is locked")
+    monkeypatch.setattr(risk_core, "_write_rows", locked_write)
+    monkeypatch.setattr(risk_core.time, "sleep", sleeps.append)
+    with pytest.raises(PermissionError):
+        append_logs([make_log_row()])
+    assert sleeps == [0.5 * 2 ** attempt for attempt in range(LOG_WRITE_RETRIES)]
+    assert not os.path.exists(LOG_FILE)
+
+
+def test_append_logs_does_not_retry_other_errors(log_dir, monkeypatch):
+    sleeps = []
+
+    def broken_write(rows):
+        raise IsADirectoryError("not a file")
+    monkeypatch.setattr(risk_core, "_write_rows", broken_write)
+    monkeypatch.setattr(risk_core.time, "sleep", sleeps.append)
+    with pytest.raises(IsADirectoryError):
+        append_logs([make_log_row()])
+    assert sleeps == []